@@ -1,223 +1,463 @@
 import requests
 import pandas as pd
-import time
+import pyarrow as pa
+import pyarrow.dataset as ds
+import simdjson
 import logging
+import queue
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from pyrate_limiter import Duration, Limiter, Rate
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
 
-# --- Directories ---
-Path("logs").mkdir(exist_ok=True)  # ensure a logs folder exists
-Path("data").mkdir(exist_ok=True)
+# --- Logging ---
+
+_queue_handler = None # the root QueueHandler installed by setup_logging, if any
+
+
+class CountryFilter(logging.Filter):
+    
+    """Give every record a `country` field so one format fits all loggers."""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "country"):
+            record.country = "-"
+        return True
+
+
+def setup_logging() -> tuple[QueueHandler, QueueListener]:
+    
+    """
+    Route all records through a queue to one shared file + console pair.
+    Workers only enqueue records; the returned listener thread does the I/O.
+    The caller removes the returned QueueHandler from the root logger and
+    stops the listener when done.
+    """
+    
+    global _queue_handler
+    
+    file_handler = logging.FileHandler("logs/fetch.log", mode="w")
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] [%(country)s] %(message)s"))
+        handler.addFilter(CountryFilter())
+    
+    # never stack a second queue handler on the root logger
+    root = logging.getLogger()
+    if _queue_handler in root.handlers:
+        root.removeHandler(_queue_handler)
+    
+    log_queue = queue.Queue()
+    _queue_handler = QueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    root.setLevel(logging.INFO)
+    
+    log_listener = QueueListener(log_queue, file_handler, stream_handler)
+    log_listener.start()
+    return _queue_handler, log_listener
+
+
+logger = logging.getLogger("api_fetcher")
 
 
 # --- Config ---
 
 BASE_URL = "https://api.worldbank.org/v2/sources/14/country/{}/series/all"
+DATASET_DIR = "data/wb" # hive-partitioned parquet: requested_country=XXX/year=YYYY/
+
+# shared by the writer and the reader: without it, partition values come back as
+# string dictionaries and a null-year partition can't be read at all
+DATASET_PARTITIONING = ds.partitioning(
+    pa.schema([("requested_country", pa.string()), ("year", pa.int16())]),
+    flavor="hive",
+)
 
 country_codes = ["EGY", "MAR", "SAU", "JOR", "TUN", "IRQ", "YEM", "OMN", "QAT", "BHR", "KWT", "DZA", "LBY"]
-params = {"format": "json", "per_page": 1000}
+
+MAX_WORKERS = 8 # countries fetched in parallel
+PAGE_WORKERS = 4 # pages of one country fetched in parallel
+
+REQUESTS_PER_SECOND = 10 # polite ceiling for the World Bank API
+
+# caps in-flight requests across all workers
+request_slots = threading.Semaphore(MAX_WORKERS)
+
+# The limiter (which starts a background leaker thread) and the cached session (which
+# creates data/wb_cache.sqlite) are built on first use, so importing this module has
+# no side effects. The lock makes sure concurrent workers share a single instance.
+_limiter = None
+_session = None
+_lazy_lock = threading.Lock()
+
+
+def get_limiter() -> Limiter:
+    
+    """Token bucket shared by every worker: requests only wait once the rate is actually reached."""
+    
+    global _limiter
+    if _limiter is None:
+        with _lazy_lock:
+            if _limiter is None:
+                _limiter = Limiter(Rate(REQUESTS_PER_SECOND, Duration.SECOND))
+    return _limiter
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    
+    """HTTPAdapter that takes a token from the shared limiter before each network request."""
+    
+    def send(self, request, *args, **kwargs):
+        get_limiter().try_acquire("worldbank") # blocks until a token is free
+        return super().send(request, *args, **kwargs)
+
+
+class RateLimitedRetry(Retry):
+    
+    """
+    Retry policy that also takes a token from the shared limiter before every retry.
+    urllib3 retries inside a single adapter send, so without this the
+    retries of throttled requests would bypass the shared bucket.
+    """
+    
+    def sleep(self, response=None):
+        super().sleep(response) # backoff / Retry-After first
+        get_limiter().try_acquire("worldbank")
+
+
+def get_session() -> CachedSession:
+    
+    """
+    One pooled keep-alive session shared by all workers; urllib3 handles retries + backoff.
+    Responses are cached in data/wb_cache.sqlite for a day, so re-runs skip the network
+    (cache hits never reach the adapter, so they don't spend rate-limit tokens).
+    """
+    
+    global _session
+    if _session is None:
+        with _lazy_lock:
+            if _session is None:
+                session = CachedSession(
+                    "data/wb_cache",
+                    backend="sqlite",
+                    expire_after=3600 * 24,
+                    allowable_methods=("GET",),
+                    stale_if_error=True,
+                )
+                # HTTP/1.1 keep-alive only: httpx/HTTP 2 multiplexing is not used because it would
+                # replace requests-cache, the urllib3 Retry policy and the rate-limited adapter.
+                session.mount("https://", RateLimitedAdapter(
+                    pool_connections=16,
+                    pool_maxsize=16,
+                    max_retries=RateLimitedRetry(total=3, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504]),
+                ))
+                _session = session
+    return _session
 
 
 # ============================================================
 # Helper functions
 # ============================================================
 
-def fetch_one_page(url:str, params:dict, max_retries: int =3, delay: float = 2.0) -> dict:
+def fetch_one_page(
+    url:str,
+    params:dict,
+    force_refresh: bool = False,
+    log: logging.Logger | logging.LoggerAdapter = logger,
+) -> simdjson.Object | dict:
     
     """
-    Fetch one page of results with retry logic and polite delay.
+    Fetch one page of results through the shared session (see `get_session`).
+    Retries and backoff are handled by the session's Retry policy;
+    concurrent callers are throttled by `request_slots`.
+    Cached responses are reused unless `force_refresh` is set.
+    Failures are reported through `log` (a worker's country-tagged adapter).
+    
+    The payload is a lazy simdjson.Object: fields only become Python
+    objects when they are read, so unused row metadata is never built.
     """
     
-    for attempt in range(max_retries):
-        try:
-            r = requests.get(url, params=params, timeout=60)
-            r.raise_for_status() #fail if not HTTP error
-            return r.json() #top level is a dict for this API
-        except requests.exceptions.RequestException as e:
-            logging.warning(f"Attempt {attempt + 1} failed for {url} (page {params.get('page')}).Error: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(delay * (attempt + 1)) #exponential backoff
-            else:
-                logging.error(f"❌ Giving up on {url} page {params.get('page')}.Error: {e}")
-                return{}
+    try:
+        with request_slots:
+            r = get_session().get(url, params=params, timeout=60, force_refresh=force_refresh)
+        r.raise_for_status() #fail if not HTTP error
+        # fresh parser per page: a simdjson parser can't be reused while
+        # objects from its previous document are still alive in other threads
+        doc = simdjson.Parser().parse(r.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        log.error(f"❌ Giving up on {url} page {params.get('page')}.Error: {e}")
+        return{}
+    
+    # the API reports errors with HTTP 200 and a top-level array: [{"message": [...]}]
+    if not isinstance(doc, simdjson.Object):
+        get_session().cache.delete(requests=[r.request]) # don't serve the error from cache on re-runs
+        log.error(f"❌ Giving up on {url} page {params.get('page')}.Error: unexpected payload {r.content[:200]!r}")
+        return{}
+    
+    return doc #top level is an object for this API
+    
+
+RECORD_COLUMNS = ["country_id", "country_name", "series_id", "series_name", "time_id", "value", "requested_country"]
+
+
+def empty_records() -> dict[str, list]:
+    
+    """Column lists that page rows are appended to (one list per output column)."""
     
+    return {col: [] for col in RECORD_COLUMNS}
+
 
-def to_lookup(var_list):
+def parse_rows(rows, records: dict[str, list], code: str) -> int:
     
     """
-    Turn a list of concept dictionaries into a lookup by concept name.
-    Example:
-        [{'concept':'Country',...}, {'concept':'Series',...}]
-    becomes
-        {'Country': {...}, 'Series': {...}}
+    Flatten one page of raw JSON rows (lazy simdjson.Objects) into `records`.
+    Fields are appended column by column instead of one dict per row;
+    DataFrame construction and type coercion happen once, after all fetches.
+    Returns the number of rows added.
     """
     
-    lookup = {}
+    # bind the hot-loop lookups once per page instead of once per row
+    add_country_id = records["country_id"].append
+    add_country_name = records["country_name"].append
+    add_series_id = records["series_id"].append
+    add_series_name = records["series_name"].append
+    add_time_id = records["time_id"].append
+    add_value = records["value"].append
+    json_object = simdjson.Object
     
-    for item in var_list or []:
-        if isinstance(item,dict) and "concept" in item:
-            concept_name = item["concept"]
-            lookup[concept_name] = item
-    return lookup
+    n = 0
+    
+    for row in rows:
+        if not isinstance(row,json_object):
+            continue
+        
+        country_id = country_name = series_id = series_name = time_id = None
+        
+        # one pass over the concept list, no intermediate lookup dict per row
+        for item in row.get("variable") or []:
+            concept = item.get("concept")
+            if concept == "Country":
+                country_id, country_name = item.get("id"), item.get("value")
+            elif concept == "Series":
+                series_id, series_name = item.get("id"), item.get("value")
+            elif concept == "Time":
+                time_id = item.get("id")
+        
+        add_country_id(country_id)
+        add_country_name(country_name)
+        add_series_id(series_id)
+        add_series_name(series_name)
+        add_time_id(time_id)
+        add_value(row.get("value"))
+        n += 1
+    
+    records["requested_country"].extend([code] * n)
+    return n
 
 
-def parse_rows(row: dict) -> dict:
+def build_frame(records: dict[str, list]) -> pd.DataFrame:
     
-    """Flatten one raw JSON row into a tidy dictionary."""
-
-    var_list = row.get("variable", [])
-    lk = to_lookup(var_list)
+    """Turn the accumulated column lists into the final tidy DataFrame."""
     
-    country_id = lk.get("Country", {}).get("id")
-    country_name = lk.get("Country",{}).get("value")
-     
-    series_id = lk.get("Series",{}).get("id")
-    series_name = lk.get("Series",{}).get("value")
+    df = pd.DataFrame(records)
     
+    # "YR2015" -> 2015, anything else -> <NA>; arrow string kernels, no per-row regex
+    time_id = df.pop("time_id").astype("string[pyarrow]")
+    years = time_id.str.slice(2).where(time_id.str.startswith("YR"))
+    df.insert(4, "year", pd.to_numeric(years, errors="coerce"))
+    df["value"] = pd.to_numeric(df["value"], errors="coerce") # one coercion pass over the whole column
     
-    time_id = lk.get("Time",{}).get("id")
-    year = None
+    # years fit in int16 and WB indicators in float32: half the memory of int64/float64
+    df = df.astype({"year": "Int16", "value": "float32"})
     
-    if isinstance(time_id,str) and time_id.startswith("YR"):
-        try:
-            year = int(time_id[2:]) # remove "YR" and convert to integer
-        except ValueError:
-            year = None
-        
-    value = row.get("value")
+    # few distinct labels repeated across many rows -> dictionary-encoded categories
+    for col in ("country_id", "country_name", "series_id", "series_name", "requested_country"):
+        df[col] = df[col].astype("category")
     
-    # Return one flat dictionary
+    return df
     
-    return{
-        "country_id": country_id,
-        "country_name": country_name,
-        "series_id": series_id,
-        "series_name": series_name,
-        "year": year,
-        "value": value
-    }
+
+def write_partitioned(df: pd.DataFrame) -> None:
     
-# ============================================================
-# Main extraction loop
-# ============================================================
+    """
+    Write `df` into DATASET_DIR, partitioned by requested_country and year.
+    Only the partitions present in `df` are replaced. Rows without a year go
+    to year=__HIVE_DEFAULT_PARTITION__; read back with `read_partitioned`.
+    """
+    
+    # the pandas metadata keeps year as Int16 when read with DATASET_PARTITIONING
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    
+    ds.write_dataset(
+        table,
+        base_dir=DATASET_DIR,
+        format="parquet",
+        partitioning=DATASET_PARTITIONING,
+        existing_data_behavior="delete_matching",
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+    )
 
-all_country_dfs = []
 
-for code in country_codes:
-    # --------------------------------------------------------
-    # Set up a logger unique to this country
-    # --------------------------------------------------------
+def read_partitioned(filters: list[tuple] | None = None) -> pd.DataFrame:
     
-    logger = logging.getLogger(code)
-    logger.setLevel(logging.INFO)
+    """
+    Read DATASET_DIR back with the writer's partition schema (year stays Int16).
+    Filters are pushed down to the partitions, e.g.
+    read_partitioned(filters=[("requested_country", "=", "EGY")]).
+    """
     
-    # file + console handlers
-    file_handler = logging.FileHandler(f"logs/{code}_fetch.log", mode="w")
-    file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    return pd.read_parquet(DATASET_DIR, partitioning=DATASET_PARTITIONING, filters=filters)
+    
+
+def fetch_country(code: str, force_refresh: bool = False) -> dict[str, list] | None:
     
-    # attach handlers
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    """
+    Fetch every page for one country (bypassing the response cache if `force_refresh`).
+    Returns the country's column lists, or None when nothing was collected.
+    """
     
+    # every record from this worker is tagged with its country
+    log = logging.LoggerAdapter(logger, {"country": code})
     
     # --------------------------------------------------------
     # Begin fetching
     # --------------------------------------------------------
     
-    
-    logger.info(f"Fetching All pages for {code} ...")
-    params = {"format": "json", "per_page": 1000, "page": 1}
+    log.info(f"Fetching All pages for {code} ...")
+    page_params = {"format": "json", "per_page": 1000, "page": 1}
     url = BASE_URL.format(code)
     
-    #NEW: hold this country's DFs here
-    dfs_this_country = [] 
+    records = empty_records()
     
-    payload = fetch_one_page(url, params)
+    payload = fetch_one_page(url, page_params, force_refresh=force_refresh, log=log)
     if not payload:
-        logger.warning(f"⚠️ SKIPPING : No payload for {code} page 1.")
-        continue
+        log.warning(f"⚠️ SKIPPING : No payload for {code} page 1.")
+        return None
     
-    #NEW : how many pages exist for this country?
+    # how many pages exist for this country?
     total_pages = payload.get("pages",1)
     
     rows = payload.get("source", {}).get("data", [])
-    parsed = [parse_rows(r) for r in rows if isinstance(r,dict)]
-    df_page1 = pd.DataFrame(parsed)
-    if not df_page1.empty:
-        df_page1['value'] = pd.to_numeric(df_page1['value'], errors='coerce')
-        dfs_this_country.append(df_page1) #Changed here to append to new list
-    else:
-        logger.warning(f"⚠️ SKIPPING Country : {code} page 1 is empty.")
-        continue
+    if not parse_rows(rows, records, code):
+        log.warning(f"⚠️ SKIPPING Country : {code} page 1 is empty.")
+        return None
     
     # --------------------------------------------------------
-    # Remaining pages
+    # Remaining pages (fetched in parallel, consumed in order)
     # --------------------------------------------------------
     
-    for p in range(2, total_pages +1):
-        params["page"] = p
-        payload_p = fetch_one_page(url, params)
-        
-        if not payload_p:
-            logger.warning(f"⚠️ Skipping page {p} for {code} (no response).")
-            continue
-        
-        rows_p = payload.get("source", {}).get("data", [])
-        parsed_p = [parse_rows(r) for r in rows_p if isinstance(r,dict)]
-        df_p = pd.DataFrame(parsed_p)
-        
-        # 🟧 Stop early if page empty
-        if df_p.empty:
-            logger.info(f"ℹ️ Page {p} for {code} is empty — stopping early.")
-            break
-        
-        df_p["value"] = pd.to_numeric(df_p["value"], errors="coerce")
-        dfs_this_country.append(df_p)
-        
-        time.sleep(0.2) #polite delay
-    
-    
-    # --------------------------------------------------------
-    # Finalize this country
-    # --------------------------------------------------------
+    def fetch_page(p: int):
+        return fetch_one_page(url, {**page_params, "page": p}, force_refresh=force_refresh, log=log)
     
-    #NEW: finalize one country
-    if dfs_this_country: #not empty
-        df_country = pd.concat(dfs_this_country, ignore_index=True)
-        df_country['requested_country'] = code
-        all_country_dfs.append(df_country)
+    pages = iter(range(2, total_pages +1))
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as page_ex:
+        # sliding window: only PAGE_WORKERS pages are in flight at once, so parsed
+        # documents never pile up in memory ahead of the loop consuming them
+        window = deque((p, page_ex.submit(fetch_page, p)) for p in islice(pages, PAGE_WORKERS))
         
-        df_country.to_csv(f"data/{code}_raw.csv", index=False)
-        logger.info(f"✅ Finished {code} with {len(df_country)} rows. Saved to data/{code}_raw.csv.")
-    else:
-        logger.warning(f"⚠️ No data collected for {code}.")
-
-
-    # detach handlers (important to avoid duplicate logs)
-    logger.removeHandler(file_handler)
-    logger.removeHandler(stream_handler)
-    file_handler.close()
-    stream_handler.close()
+        while window:
+            p, future = window.popleft()
+            next_page = next(pages, None)
+            if next_page is not None:
+                window.append((next_page, page_ex.submit(fetch_page, next_page)))
+            
+            payload_p = future.result()
+            if not payload_p:
+                log.warning(f"⚠️ Skipping page {p} for {code} (no response).")
+                continue
+            
+            rows_p = payload_p.get("source", {}).get("data", [])
+            
+            # 🟧 Stop early if page empty
+            if not parse_rows(rows_p, records, code):
+                log.info(f"ℹ️ Page {p} for {code} is empty — stopping early.")
+                break
+    
+    log.info(f"✅ Finished {code} with {len(records['value'])} rows.")
+    return records
 
 # ============================================================
-# Combine all results
+# Entry point
 # ============================================================
-if all_country_dfs:
-    df = pd.concat(all_country_dfs, ignore_index=True)
-    df.to_csv("data/all_countries_combined.csv", index=False)
-    print(f"\n✅ Combined dataset saved → data/all_countries_combined.csv ({len(df)} rows)")
-else:
-    print("\n⚠️ No data fetched for any country.")
-    
-
-print("\nFinal Summary:")
-logger.info("Total rows:", len(df))
-if not df.empty:
-    logger.info("Unique countries:", df['country_id'].nunique())
-    logger.info("Unique series:", df['series_id'].nunique())
-
 
+def main() -> None:
     
-
+    """Fetch every country, save the partitioned dataset and combined Parquet file, log a summary."""
+    
+    Path("logs").mkdir(exist_ok=True)  # ensure a logs folder exists
+    Path("data").mkdir(exist_ok=True)
     
+    root = logging.getLogger()
+    previous_level = root.level
+    queue_handler, log_listener = setup_logging()
+    force_refresh = "--refresh" in sys.argv[1:] # bypass the on-disk response cache
+    
+    try:
+        # --------------------------------------------------------
+        # Main extraction loop
+        # --------------------------------------------------------
+        
+        country_records = {}
+        
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = {ex.submit(fetch_country, c, force_refresh): c for c in country_codes}
+            for future in as_completed(futures):
+                code = futures[future]
+                try:
+                    records = future.result()
+                except Exception:
+                    # one failed country must not cost the others their data
+                    logger.exception(f"❌ Fetching {code} failed.", extra={"country": code})
+                    continue
+                if records is not None:
+                    country_records[code] = records
+                else:
+                    logger.warning(f"⚠️ No data collected for {code}.", extra={"country": code})
+        
+        # --------------------------------------------------------
+        # Combine all results
+        # --------------------------------------------------------
+        
+        # flatten in the configured country order, then build the frame once
+        all_records = empty_records()
+        for code in country_codes:
+            for col, values in country_records.get(code, {}).items():
+                all_records[col].extend(values)
+        
+        if not country_records:
+            print("\n⚠️ No data fetched for any country.")
+            return
+        
+        df = build_frame(all_records)
+        
+        write_partitioned(df)
+        print(f"✅ Saved {df['requested_country'].nunique()} countries → {DATASET_DIR}/ (partitioned by country/year)")
+        
+        # parquet keeps the Int16/float32 dtypes and compresses far better than csv
+        df.to_parquet("data/all_countries_combined.parquet", engine="pyarrow", compression="zstd", index=False)
+        print(f"\n✅ Combined dataset saved → data/all_countries_combined.parquet ({len(df)} rows)")
+        
+        # one record for the whole summary, formatted up front
+        logger.info(
+            f"Final Summary: total rows: {len(df)}; "
+            f"unique countries: {df['country_id'].nunique()}; "
+            f"unique series: {df['series_id'].nunique()}"
+        )
+    
+    finally:
+        # detach first so nothing is enqueued after the listener stops
+        root.removeHandler(queue_handler)
+        root.setLevel(previous_level)
+        log_listener.stop() # flush queued records
+        for handler in log_listener.handlers:
+            handler.close()
+
+
+if __name__ == "__main__":
+    main()